@@ -0,0 +1,59 @@
+"""Backends used by the controller to talk to the cloud and the nodes
+
+The controller only relies on the interface of the following classes so
+that alternative implementations (see nxdd.fakes) can be plugged in.
+"""
+import os
+from time import sleep
+
+
+class EC2Backend(object):
+    """Cloud backend using the EC2 API through boto"""
+
+    @property
+    def ResponseError(self):
+        from boto.exception import EC2ResponseError
+        return EC2ResponseError
+
+    def connect(self, region, **ec2_params):
+        """Return a boto EC2Connection like object for region"""
+        # boto is only required when actually talking to EC2
+        from boto import ec2
+        return ec2.connect_to_region(region, **ec2_params)
+
+    def sleep(self, delay):
+        """Wait for the cloud resources to change state"""
+        sleep(delay)
+
+
+class SSHTransport(object):
+    """Remote transport shelling out to the ssh, scp and rsync commands"""
+
+    def run(self, key_file, host, command):
+        """Execute command on host, return the status given by os.system"""
+        return os.system(
+            "ssh -o \"StrictHostKeyChecking no\"  -i %s %s '%s'" %
+            (key_file, host, command))
+
+    def send(self, key_file, local, remote, rsync=True):
+        """Copy local path to remote 'host:path', return the exit code"""
+        if rsync:
+            cmd = ('rsync -Paz'
+                   ' --rsh "ssh -o \'StrictHostKeyChecking no\' -i %s"'
+                   ' --rsync-path "sudo rsync" %s %s' %
+                   (key_file, local, remote))
+        else:
+            cmd = "scp -r -o \"StrictHostKeyChecking no\" -i %s %s %s" % (
+                key_file, local, remote)
+        return os.system(cmd)
+
+    def fetch(self, key_file, remote, local):
+        """Copy remote 'host:path' to local path, return the exit code"""
+        return os.system(
+            'rsync -az'
+            ' --rsh "ssh -o \'StrictHostKeyChecking no\' -i %s"'
+            ' --rsync-path "sudo rsync" %s %s' % (key_file, remote, local))
+
+    def sleep(self, delay):
+        """Wait before retrying to connect"""
+        sleep(delay)
@@ -0,0 +1,309 @@
+"""Benchmark the overhead of the deployment orchestration.
+
+The controller is run against the in-process fakes of nxdd.fakes so that
+no AWS account nor network access is required. The following command
+times the connection, upload, termination and full deployment phases for
+fleets of 1, 10 and 100 instances along with the startup time of the
+command line::
+
+    $ python -m nxdd.benchmark \\
+             --instances 1 10 100 \\
+             --api-latency 0.1 \\
+             --boot-delay 60 \\
+             --output bench.json
+
+The 'wall' column is the real time spent, the 'simulated' column is the
+time the same run would have spent waiting for the cloud and the nodes
+according to the virtual clock of the fakes.
+
+The benchmark exits with a non zero code if the command line startup
+exceeds its time budget, if boto is imported before being needed or if
+the status, plan and terminate operations issue more API calls than
+needed.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from nxdd import commandline
+from nxdd.controller import Controller
+from nxdd.fakes import FakeClock, FakeEC2Backend, FakeTransport
+
+REGION_NAME = 'fake-region-1'
+IMAGE_ID = 'ami-00000000'
+INSTANCE_TYPE = 'm1.medium'
+USER = 'ubuntu'
+
+# Maximum number of API calls per instance for the lightweight operations
+API_CALLS_BUDGETS = {
+    # a single filtered listing of the instances
+    'status': 1,
+    # a single filtered listing as the journal is empty after a successful
+    # deployment, the remote state is checked over ssh
+    'plan': 1,
+    # list the spot requests, cancel, list the instances, terminate
+    'terminate-cli': 4,
+}
+
+
+def make_cli_parser():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the deployer against fake EC2 and SSH.",
+    )
+    parser.add_argument(
+        "--instances", nargs="+", type=int, default=[1, 10, 100],
+        help="Sizes of the fleets of instances to deploy.",
+    )
+    parser.add_argument(
+        "--api-latency", type=float, default=0.0,
+        help="Simulated latency of each EC2 API call in seconds.",
+    )
+    parser.add_argument(
+        "--boot-delay", type=float, default=0.0,
+        help="Simulated delay for a new instance to be running in seconds.",
+    )
+    parser.add_argument(
+        "--spot-delay", type=float, default=0.0,
+        help="Simulated delay for spot requests fulfilment in seconds.",
+    )
+    parser.add_argument(
+        "--ssh-latency", type=float, default=0.0,
+        help="Simulated latency of each remote command in seconds.",
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=None,
+        help="Simulated upload bandwidth in bytes per second.",
+    )
+    parser.add_argument(
+        "--bid", type=float, default=0.1,
+        help="Bid price, set to 0 to simulate on demand provisioning.",
+    )
+    parser.add_argument(
+        "--package-size", type=int, default=1024 * 1024,
+        help="Size in bytes of the marketplace package to upload.",
+    )
+    parser.add_argument(
+        "--time-scale", type=float, default=0.0,
+        help=("Real seconds slept per simulated second. The default (0) "
+              "only measures the overhead of the deployer."),
+    )
+    parser.add_argument(
+        "--startup-budget", type=float, default=0.2,
+        help=("Maximum time in seconds spent by the command line to start "
+              "on top of the Python interpreter startup."),
+    )
+    parser.add_argument(
+        "--output",
+        help="JSON file to store the results for later comparison.",
+    )
+    return parser
+
+
+@contextmanager
+def quiet():
+    """Silence the progress messages of the deployer"""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def make_backends(options):
+    clock = FakeClock(options.time_scale)
+    cloud = FakeEC2Backend(clock, api_latency=options.api_latency,
+                           boot_delay=options.boot_delay,
+                           spot_delay=options.spot_delay)
+    transport = FakeTransport(clock, latency=options.ssh_latency,
+                              bandwidth=options.bandwidth)
+    return clock, cloud, transport
+
+
+def measure(phase, n_instances, clock, cloud, func):
+    api_calls = sum(cloud.api_calls.values())
+    simulated = clock.now
+    tick = time.time()
+    with quiet():
+        func()
+    return {
+        'phase': phase,
+        'instances': n_instances,
+        'wall': time.time() - tick,
+        'api_calls': sum(cloud.api_calls.values()) - api_calls,
+        'simulated': clock.now - simulated,
+    }
+
+
+def run_benchmark(n_instances, options, package, working_dir):
+    names = ['bench-%03d' % i for i in range(n_instances)]
+    remote_path = '/home/%s/bench/%s' % (USER, os.path.basename(package))
+    results = []
+
+    # Individual controller operations on the same fleet
+    clock, cloud, transport = make_backends(options)
+    keys_folder = os.path.join(working_dir, 'keys-ops-%d' % n_instances)
+    controllers = []
+
+    def connect():
+        for name in names:
+            ctl = Controller(REGION_NAME, name, keys_folder, ssh_user=USER,
+                             cloud=cloud, transport=transport)
+            ctl.connect(name, IMAGE_ID, INSTANCE_TYPE, bid_price=options.bid)
+            controllers.append(ctl)
+
+    def upload():
+        for ctl in controllers:
+            ctl.put(package, remote_path)
+
+    def terminate():
+        for name, ctl in zip(names, controllers):
+            ctl.terminate(name)
+
+    for phase, func in [('connect', connect), ('upload', upload),
+                        ('terminate', terminate)]:
+        results.append(measure(phase, n_instances, clock, cloud, func))
+
+    # Complete deployments from the command line on a fresh fleet
+    clock, cloud, transport = make_backends(options)
+    keys_folder = os.path.join(working_dir, 'keys-main-%d' % n_instances)
+
+    def deploy():
+        for name in names:
+            commandline.main([
+                '--instance-name', name,
+                '--region-name', REGION_NAME,
+                '--image-id', IMAGE_ID,
+                '--instance-type', INSTANCE_TYPE,
+                '--keys-folder', keys_folder,
+                '--user', USER,
+                '--bid', str(options.bid),
+                '--package', package,
+            ], cloud=cloud, transport=transport)
+
+    def cli(*args):
+        def run():
+            for name in names:
+                commandline.main(['--instance-name', name,
+                                  '--region-name', REGION_NAME,
+                                  '--keys-folder', keys_folder] + list(args),
+                                 cloud=cloud, transport=transport)
+        return run
+
+    for phase, func in [('main', deploy),
+                        ('status', cli('--status')),
+                        ('plan', cli('--plan', '--package', package)),
+                        ('terminate-cli', cli('--terminate'))]:
+        results.append(measure(phase, n_instances, clock, cloud, func))
+    return results
+
+
+def best_time(cmd, repeat=5):
+    """Best wall time of a subprocess run with nxdd on the Python path"""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    best = None
+    for i in range(repeat):
+        tick = time.time()
+        with open(os.devnull, 'w') as devnull:
+            code = subprocess.call(cmd, env=env, stdout=devnull)
+        duration = time.time() - tick
+        if code != 0:
+            raise RuntimeError('Command %r returned %d' % (cmd, code))
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def measure_startup():
+    """Startup overhead of the command line on top of the interpreter"""
+    interpreter = best_time([sys.executable, '-c', 'pass'])
+    import_time = best_time([
+        sys.executable, '-c',
+        'import sys, nxdd.commandline; '
+        'sys.exit(1 if "boto" in sys.modules else 0)'])
+    help_time = best_time([sys.executable, '-m', 'nxdd.commandline',
+                           '--help'])
+    return {
+        'interpreter': interpreter,
+        'import': import_time - interpreter,
+        'help': help_time - interpreter,
+    }
+
+
+def check_budgets(startup, results, options):
+    """Return the list of exceeded budgets"""
+    failures = []
+    for key in ('import', 'help'):
+        if startup[key] > options.startup_budget:
+            failures.append('Command line %s took %.3fs (budget %.3fs)'
+                            % (key, startup[key], options.startup_budget))
+    for r in results:
+        budget = API_CALLS_BUDGETS.get(r['phase'])
+        if budget is not None and r['api_calls'] > budget * r['instances']:
+            failures.append('%s issued %d API calls for %d instances '
+                            '(budget %d per instance)' % (
+                                r['phase'], r['api_calls'], r['instances'],
+                                budget))
+    return failures
+
+
+def format_results(results):
+    lines = ['%-13s %9s %9s %17s %9s %12s' % (
+        'phase', 'instances', 'wall(s)', 'per instance(ms)', 'api calls',
+        'simulated(s)')]
+    for r in results:
+        lines.append('%-13s %9d %9.3f %17.2f %9d %12.1f' % (
+            r['phase'], r['instances'], r['wall'],
+            1000 * r['wall'] / r['instances'], r['api_calls'],
+            r['simulated']))
+    return "\n".join(lines)
+
+
+def main(argv=sys.argv[1:]):
+    options = make_cli_parser().parse_args(argv)
+    try:
+        startup = measure_startup()
+    except RuntimeError as e:
+        # The import command fails if boto is imported eagerly
+        print("Command line startup check failed: %s" % e)
+        return 1
+    working_dir = tempfile.mkdtemp(prefix='demo-deployer-benchmark-')
+    try:
+        package = os.path.join(working_dir, 'bench-package-1.0.zip')
+        with open(package, 'wb') as f:
+            f.write(os.urandom(options.package_size))
+
+        results = []
+        for n_instances in options.instances:
+            results.extend(run_benchmark(n_instances, options, package,
+                                         working_dir))
+    finally:
+        shutil.rmtree(working_dir)
+
+    print("Command line startup: import %.1fms, --help %.1fms "
+          "(interpreter %.1fms)" % (1000 * startup['import'],
+                                    1000 * startup['help'],
+                                    1000 * startup['interpreter']))
+    print(format_results(results))
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'startup': startup,
+                       'results': results}, f, indent=2)
+
+    failures = check_budgets(startup, results, options)
+    for failure in failures:
+        print('Budget exceeded: ' + failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,6 +26,8 @@ import json
 import tempfile
 
 from nxdd.controller import Controller
+from nxdd.history import DeploymentHistory
+from nxdd.journal import DeploymentJournal, digest, file_digest
 
 # From http://cloud-images.ubuntu.com/desktop/precise/current/
 
@@ -37,6 +39,7 @@ DEFAULT_REGION_NAME = 'eu-west-1'
 DEFAULT_KEYS_FOLDER = '~/aws'
 DEFAULT_USER = 'ubuntu'
 DEFAULT_BID = 0.1
+PARAMETERS_FILENAME = 'demo-deployer-params.json'
 
 
 def make_cli_parser():
@@ -105,11 +108,19 @@ def make_cli_parser():
               "Set to 0 or -1 to use regular on demand provisioning."),
         default=DEFAULT_BID,
     )
-    parser.add_argument(
+    # Operations that replace the deployment
+    operations = parser.add_mutually_exclusive_group()
+    operations.add_argument(
         "--terminate", action="store_true",
         help=("Terminate the instance name."),
         default=False,
     )
+    operations.add_argument(
+        "--status", action="store_true",
+        help=("Print the status of the instance name and exit with a non "
+              "zero code if it is not running."),
+        default=False,
+    )
     parser.add_argument(
         "--deployment-script",
         help=("Custom deployment script to override the default."),
@@ -122,16 +133,41 @@ def make_cli_parser():
         "--instance-clid",
         help="instance.clid file to connect the server to Nuxeo Connect."
     )
+    parser.add_argument(
+        "--journal-folder",
+        help=("Local folder to store the journal of completed deployment "
+              "phases used to resume failed runs. Defaults to keys-folder."),
+    )
+    parser.add_argument(
+        "--no-resume", action="store_false", dest="resume",
+        help=("Ignore the journal of a previous failed run and redeploy "
+              "from scratch."),
+        default=True,
+    )
+    operations.add_argument(
+        "--plan", action="store_true",
+        help=("Print the actions of the deployment along with their "
+              "estimated duration and exit without changing anything."),
+        default=False,
+    )
+    parser.add_argument(
+        "--history-file",
+        help=("JSON file storing the timings of past deployments used to "
+              "estimate the duration of the plan. Defaults to "
+              "deploy-history.json in the journal folder."),
+    )
     return parser
 
 
-def main(argv=sys.argv[1:]):
+def main(argv=sys.argv[1:], cloud=None, transport=None):
+    """Deploy the demo, cloud and transport default to EC2 and SSH"""
     parser = make_cli_parser()
     options = parser.parse_args(argv)
 
     tick = time.time()
 
-    if options.keypair_name is None and not options.terminate:
+    if (options.keypair_name is None and not options.terminate
+            and not options.status):
         options.keypair_name = options.instance_name
 
     # TODO: application_name should be an independent option in the future
@@ -152,71 +188,259 @@ def main(argv=sys.argv[1:]):
 
     ctl = Controller(options.region_name, options.keypair_name,
                      options.keys_folder, ssh_user=options.user,
-                     **aws_credentials)
+                     cloud=cloud, transport=transport, **aws_credentials)
+
+    journal_folder = options.journal_folder or options.keys_folder
+    journal = DeploymentJournal.for_instance(journal_folder,
+                                             options.instance_name)
 
     if options.terminate:
         ctl.terminate(options.instance_name)
+        journal.clear()
+        return 0
+
+    if options.status:
+        instance = ctl.get_running_instance(options.instance_name)
+        if instance is None:
+            print("No running instance with name '%s'."
+                  % options.instance_name)
+            return 1
+        print("Instance '%s' (%s) running at: http://%s/" % (
+            options.instance_name, instance.id, instance.dns_name))
+        return 0
+
+    history = DeploymentHistory(
+        options.history_file
+        or os.path.join(journal_folder, 'deploy-history.json'))
+
+    if options.plan:
+        from nxdd.planner import make_plan, format_plan
+        print(format_plan(make_plan(ctl, options, journal, history)))
         return 0
 
+    if not options.resume:
+        journal.clear()
+
+    # Reuse the instance recorded by a previous run if any to avoid listing
+    # all the instances of the region
+    connect_digest = get_connect_digest(options)
+    previous = journal.get('connect') or {}
+    instance_id = None
+    if journal.is_completed('connect', connect_digest):
+        instance_id = previous['instance_id']
+    connect_tick = time.time()
     ctl.connect(options.instance_name, options.image_id,
                 options.instance_type, ports=(22, 80, 443, 8080),
-                bid_price=options.bid)
+                bid_price=options.bid, instance_id=instance_id)
+    connect_duration = time.time() - connect_tick
+    instance_id = ctl.instance.id
+    created = ctl.created_instance
+    if not created and previous.get('instance_id') == instance_id:
+        # The instance was created by a previous failed run
+        created = previous.get('created', False)
+        if created:
+            connect_duration = journal.phases['connect'].get('duration')
+    journal.record('connect', connect_digest,
+                   {'instance_id': instance_id, 'created': created},
+                   connect_duration)
+
+    phases = deployment_phases(ctl, options, instance_id)
+    for phase in phases:
+        journal.run(phase['name'], phase['digest'], phase['func'],
+                    *phase['args'])
+
+    record_history(history, options, created, journal, phases)
+
+    # The deployment is complete: the next run will redeploy from scratch
+    journal.clear()
+    duration = time.time() - tick
+    print("Successfully deployed demo at: http://%s/ in %dmin %ds" %
+          (ctl.instance.dns_name, duration // 60, duration % 60))
+    return 0
+
+
+def get_connect_digest(options):
+    return digest(options.region_name, options.instance_name,
+                  options.image_id, options.instance_type, options.bid)
+
+
+def get_deployment_script(options):
+    if options.deployment_script is not None:
+        return options.deployment_script
 
-    WORKING_DIR = '/home/%s/%s/' % (options.user, options.application_name)
-    ctl.cmd('sudo mkdir -p ' + WORKING_DIR)
-    ctl.cmd('sudo chown -R %s:%s %s'
-                    % (options.user, options.user, WORKING_DIR))
+    from nxdd import node_agent
+    # TODO: check that the module source file exists on the hard
+    # drive, if not fallback to inspect module to fetch the source
+    # code instead
+    deployment_script = node_agent.__file__
+
+    if deployment_script.endswith('.pyc'):
+        deployment_script = deployment_script[:-len('.pyc')] + '.py'
+    return deployment_script
+
+
+def deployment_phases(ctl, options, instance_id):
+    """Ordered phases of the deployment following the connection
+
+    Each phase is a dict with the name and inputs digest used by the
+    journal, the number of bytes to send to the node, a description and
+    the function to call with its arguments. All the digests depend on the
+    instance id so that phases run on a previous instance are invalidated.
+    """
+    working_dir = '/home/%s/%s/' % (options.user, options.application_name)
+    phases = [dict(
+        name='working_directory',
+        digest=digest(instance_id, options.user, working_dir),
+        bytes=0,
+        description='Create working directory ' + working_dir,
+        func=setup_working_directory,
+        args=(ctl, options.user, working_dir),
+    )]
 
     # Upload packages if any
+    uploads = []
     package_names = []
     for package_local_path in options.packages:
         if os.path.exists(package_local_path):
             package_filename = os.path.basename(package_local_path)
             package_names.append(package_filename)
-            ctl.put(package_local_path, WORKING_DIR + package_filename)
+            uploads.append((package_local_path,
+                            working_dir + package_filename))
         else:
             # Assume a preinstalled package name such as 'nuxeo-dm'
             package_names.append(package_local_path)
 
     # Deploy Nuxeo Connect instance credentials
     if options.instance_clid is not None:
-        ctl.put(options.instance_clid, WORKING_DIR + 'instance.clid')
+        uploads.append((options.instance_clid, working_dir + 'instance.clid'))
 
-    # Setup the node by running a script
-    if options.deployment_script is not None:
-        deployment_script = options.deployment_script
-    else:
-        from nxdd import node_agent
-        # TODO: check that the module source file exists on the hard
-        # drive, if not fallback to inspect module to fetch the source
-        # code instead
-        deployment_script = node_agent.__file__
-
-        if deployment_script.endswith('.pyc'):
-            deployment_script = deployment_script[:-len('.pyc')] + '.py'
+    for local_path, remote_path in uploads:
+        phases.append(dict(
+            name='upload:' + remote_path,
+            digest=digest(instance_id, remote_path,
+                          file_digest(local_path)),
+            bytes=path_size(local_path),
+            description='Send ' + local_path,
+            func=ctl.put,
+            args=(local_path, remote_path),
+        ))
 
     parameters = dict(
         distribution=options.nuxeo_distribution,
         marketplace_packages=package_names,
     )
+    parameters_digest = digest(instance_id, working_dir, parameters)
+    phases.append(dict(
+        name='parameters',
+        digest=parameters_digest,
+        bytes=len(json.dumps(parameters)),
+        description='Send the deployment parameters',
+        func=upload_parameters,
+        args=(ctl, parameters, working_dir),
+    ))
+
+    # Setup the node by running a script. The agent phase is invalidated by
+    # any change in the uploaded files through the invalidation of the
+    # previous phases.
+    deployment_script = get_deployment_script(options)
+    phases.append(dict(
+        name='agent',
+        digest=digest(parameters_digest, file_digest(deployment_script)),
+        bytes=path_size(deployment_script),
+        description='Run ' + os.path.basename(deployment_script),
+        func=run_agent,
+        args=(ctl, deployment_script, PARAMETERS_FILENAME, working_dir),
+    ))
+    return phases
+
+
+def path_size(path):
+    """Size in bytes of a file or of the content of a folder"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, dirs, files in os.walk(path)
+               for filename in files)
+
+
+def record_history(history, options, created, journal, phases):
+    """Store the durations of the phases of a complete deployment"""
+    durations = {}
+    upload_bytes = 0
+    upload_duration = 0.0
+    for phase in [{'name': 'connect', 'bytes': 0}] + phases:
+        record = journal.phases.get(phase['name'])
+        if record is None or record.get('duration') is None:
+            continue
+        if phase['name'].startswith('upload:'):
+            upload_bytes += phase['bytes']
+            upload_duration += record['duration']
+            continue
+        durations[phase['name']] = record['duration']
+
+    # Durations of the individual steps run by the node agent
+    summary = journal.get('agent') or {}
+    for step in summary.get('steps', ()):
+        durations['agent:' + step['name']] = step['duration']
+
+    history.record(options.instance_type, options.nuxeo_distribution, created,
+                   summary.get('nuxeo_installed'), durations,
+                   upload_bytes=upload_bytes,
+                   upload_duration=upload_duration)
+
+
+def setup_working_directory(ctl, user, working_dir):
+    ctl.cmd('sudo mkdir -p ' + working_dir)
+    ctl.cmd('sudo chown -R %s:%s %s' % (user, user, working_dir))
+
+
+def upload_parameters(ctl, parameters, working_dir):
+    """Send the parameters of the node agent"""
     try:
         fd, params_filepath = tempfile.mkstemp(
             prefix='demo-deployer-params-', suffix='.json')
         os.close(fd)
-        with open(params_filepath, 'wb') as f:
+        with open(params_filepath, 'w') as f:
             json.dump(parameters, f)
-        params_filename = os.path.basename(params_filepath)
-        ctl.put(params_filepath, WORKING_DIR + params_filename)
+        ctl.put(params_filepath, working_dir + PARAMETERS_FILENAME)
     finally:
         os.unlink(params_filepath)
 
-    ctl.exec_script(deployment_script,
-                    sudo=True, arguments=params_filename,
-                    working_directory=WORKING_DIR)
-    duration = time.time() - tick
-    print("Successfully deployed demo at: http://%s/ in %dmin %ds" %
-          (ctl.instance.dns_name, duration // 60, duration % 60))
-    return 0
+
+def run_agent(ctl, deployment_script, params_filename, working_dir):
+    """Run the deployment script, return the node resource usage summary"""
+    from nxdd.node_agent import RESOURCE_SUMMARY_FILE
+    # Do not report the summary of a previous run
+    ctl.cmd('sudo rm -f ' + working_dir + RESOURCE_SUMMARY_FILE)
+    try:
+        ctl.exec_script(deployment_script, sudo=True,
+                        arguments=params_filename,
+                        working_directory=working_dir)
+    finally:
+        # Report the resource usage even if the deployment failed
+        summary = fetch_resource_summary(ctl, working_dir)
+    return summary
+
+
+def fetch_resource_summary(ctl, working_dir):
+    from nxdd.node_agent import RESOURCE_SUMMARY_FILE
+    from nxdd.node_agent import format_resource_summary
+    fd, summary_filepath = tempfile.mkstemp(
+        prefix='demo-deployer-resources-', suffix='.json')
+    os.close(fd)
+    try:
+        ctl.get(working_dir + RESOURCE_SUMMARY_FILE, summary_filepath)
+        with open(summary_filepath, 'r') as f:
+            summary = json.load(f)
+    except (RuntimeError, ValueError):
+        # Custom deployment scripts do not sample the node resources
+        print("No resource usage summary available.")
+        return None
+    finally:
+        os.unlink(summary_filepath)
+    print("Resource usage on the node per deployment step:")
+    print(format_resource_summary(summary))
+    return summary
 
 if __name__ == "__main__":
     sys.exit(main())
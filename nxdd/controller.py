@@ -2,10 +2,8 @@
 from __future__ import print_function
 import sys
 import os
-from time import sleep
 
-from boto import ec2
-from boto.exception import EC2ResponseError
+from nxdd.backends import EC2Backend, SSHTransport
 
 
 def pflush(*args, **kwargs):
@@ -18,15 +16,26 @@ class Controller(object):
     """Utility class to control the cloud nodes"""
 
     def __init__(self, region, keypair_name=None, keys_folder=None, ssh_user='ubuntu',
-                 **ec2_params):
-        self.conn = ec2.connect_to_region(region, **ec2_params)
-
-        # issue a dummy query to check the connection
-        self.conn.get_all_instances()
+                 cloud=None, transport=None, **ec2_params):
+        self.cloud = cloud if cloud is not None else EC2Backend()
+        self.transport = transport if transport is not None else SSHTransport()
+        self.region = region
+        self.ec2_params = ec2_params
+        self._conn = None
 
         self.ssh_user = ssh_user
-        if keypair_name is not None:
-            self.setup_keypair(keypair_name, keys_folder)
+        # The keypair is only checked (or created) when connecting to a node
+        # to avoid useless API calls for terminate or status operations
+        self.keypair_name = keypair_name
+        self.keys_folder = keys_folder
+        self.key_file = None
+
+    @property
+    def conn(self):
+        """Connection to the cloud API, opened on first use"""
+        if self._conn is None:
+            self._conn = self.cloud.connect(self.region, **self.ec2_params)
+        return self._conn
 
     def setup_keypair(self, keypair_name, keys_folder):
         if keys_folder is None:
@@ -36,11 +45,12 @@ class Controller(object):
             os.makedirs(keys_folder)
 
         self.keypair_name = keypair_name
-        self.key_file = os.path.join(keys_folder, keypair_name + '.pem')
+        self.keys_folder = keys_folder
+        self.key_file = self.get_local_key_file()
 
         try:
             kp = self.conn.get_key_pair(keypair_name)
-        except EC2ResponseError:
+        except self.cloud.ResponseError:
             kp = None
 
         if os.path.exists(self.key_file):
@@ -66,12 +76,26 @@ class Controller(object):
             kp.save(keys_folder)
             pflush('Saved key file:', self.key_file)
 
+    def get_local_key_file(self):
+        """Path of the private key file, without checking it exists"""
+        if self.keypair_name is None or self.keys_folder is None:
+            return None
+        return os.path.join(os.path.expanduser(self.keys_folder),
+                            self.keypair_name + '.pem')
+
+    def check_keypair(self):
+        if self.keypair_name is not None and self.key_file is None:
+            self.setup_keypair(self.keypair_name, self.keys_folder)
+
     def get_connection(self):
         return self.conn
 
     def get_running_instance(self, instance_name):
         instances = []
-        for r in self.conn.get_all_instances():
+        # Filter on the server side to avoid fetching the whole region
+        filters = {'instance-state-name': 'running',
+                   'tag-value': instance_name}
+        for r in self.conn.get_all_instances(filters=filters):
             for i in r.instances:
                 if ((i.tags.get('Name') == instance_name
                      or i.tags.get('name') == instance_name)
@@ -88,6 +112,18 @@ class Controller(object):
 
         return instances[0]
 
+    def get_instance(self, instance_id):
+        """Fetch a running instance by id without listing the whole region"""
+        try:
+            reservations = self.conn.get_all_instances([instance_id])
+        except self.cloud.ResponseError:
+            return None
+        for r in reservations:
+            for i in r.instances:
+                if i.id == instance_id and i.state == 'running':
+                    return i
+        return None
+
     def create_instance(self, instance_name, image_id, instance_type,
                         security_groups=(), ports=(22, 80, 443),
                         bid_price=None):
@@ -95,8 +131,10 @@ class Controller(object):
         if not security_groups:
             # check whether there already exist a security group named after
             # the instance name
-            existing_groups = [g for g in self.conn.get_all_security_groups()
-                               if g.name == instance_name]
+            existing_groups = [
+                g for g in self.conn.get_all_security_groups(
+                    filters={'group-name': instance_name})
+                if g.name == instance_name]
             if not existing_groups:
                 # create a security group with the instance_name and grant the
                 # necessary rights for ssh and 8080
@@ -147,12 +185,13 @@ class Controller(object):
                 if spot_request.state == 'open':
                     pflush('Waiting %ds for Spot Instance request '
                            'to be fulfilled.' % delay)
-                    sleep(delay)
+                    self.cloud.sleep(delay)
                     continue
 
                 elif spot_request.state == 'active':
                     reservation = self.conn.get_all_instances(
                         [spot_request.instance_id])[0]
+                    break
 
             if reservation is None:
                 spot_request.cancel()
@@ -162,7 +201,7 @@ class Controller(object):
         instance = reservation.instances[0]
         # wait a bit before creating the tag otherwise it might be impossible
         # to fetch the status of the instance (AWS bug?).
-        sleep(0.5)
+        self.cloud.sleep(0.5)
         self.conn.create_tags([instance.id], {"Name": instance_name})
 
         retries = 0
@@ -170,7 +209,7 @@ class Controller(object):
         while instance.state != 'running' and retries < 10:
             pflush("Waiting %ds for instance '%s' to startup (state='%s')..."
                   % (delay, instance_name, instance.state))
-            sleep(delay)
+            self.cloud.sleep(delay)
             instance.update()
             retries += 1
         return instance
@@ -183,15 +222,30 @@ class Controller(object):
                   % self.instance.dns_name)
             if self.cmd('echo "connection check"', raise_if_fail=False) == 0:
                 return
-            sleep(delay)
+            self.transport.sleep(delay)
             retries += 1
         raise RuntimeError('Failed to connect via ssh')
 
     def connect(self, instance_name, image_id, instance_type,
-                security_groups=(), ports=(22, 80, 443), bid_price=None):
-        """Connect the crontroller to the remote node, create it if missing"""
-        instance = self.get_running_instance(instance_name)
+                security_groups=(), ports=(22, 80, 443), bid_price=None,
+                instance_id=None):
+        """Connect the crontroller to the remote node, create it if missing
+
+        If instance_id is provided (e.g. recorded by a previous run), the
+        instance is looked up directly by id and the lookup by name is only
+        used as a fallback.
+        """
+        self.check_keypair()
+        instance = None
+        if instance_id is not None:
+            instance = self.get_instance(instance_id)
+            if instance is not None and instance_name not in (
+                    instance.tags.get('Name'), instance.tags.get('name')):
+                instance = None
+        if instance is None:
+            instance = self.get_running_instance(instance_name)
 
+        self.created_instance = instance is None
         if instance is not None:
             pflush("Reusing running instance with name '%s' at %s" % (
                 instance_name, instance.dns_name))
@@ -207,9 +261,13 @@ class Controller(object):
             pflush("Started instance with name '%s' at %s" % (
                 instance_name, instance.dns_name))
 
+        self.attach(instance)
+        self.check_ssh_connection()
+
+    def attach(self, instance):
+        """Use instance as the remote node without checking the connection"""
         self.instance = instance
         self.ssh_host = "%s@%s" % (self.ssh_user, self.instance.dns_name)
-        self.check_ssh_connection()
 
     def check_connected(self):
         if not hasattr(self, 'ssh_host') or self.ssh_host is None:
@@ -219,8 +277,7 @@ class Controller(object):
     def cmd(self, cmd, raise_if_fail=True):
         self.check_connected()
         pflush(">", cmd)
-        code = os.system("ssh -o \"StrictHostKeyChecking no\"  -i %s %s '%s'" %
-                  (self.key_file, self.ssh_host, cmd))
+        code = self.transport.run(self.key_file, self.ssh_host, cmd)
         if code != 0 and raise_if_fail:
             raise RuntimeError("Remote command %s return %d" % (cmd, code))
         return code
@@ -229,19 +286,19 @@ class Controller(object):
         self.check_connected()
         remote = "%s:%s" % (self.ssh_host, remote)
         pflush("> Sending '%s' to '%s'" % (local, remote))
-        if rsync:
-            cmd = ('rsync -Paz'
-                   ' --rsh "ssh -o \'StrictHostKeyChecking no\' -i %s"'
-                   ' --rsync-path "sudo rsync" %s %s' %
-                   (self.key_file, local, remote))
-        else:
-            cmd = "scp -r -o \"StrictHostKeyChecking no\" -i %s %s %s" % (
-                self.key_file, local, remote)
-
-        code = os.system(cmd)
+        code = self.transport.send(self.key_file, local, remote, rsync=rsync)
         if code != 0:
             raise RuntimeError("Failed to send '%s' to '%s'" % (local, remote))
 
+    def get(self, remote, local):
+        self.check_connected()
+        remote = "%s:%s" % (self.ssh_host, remote)
+        pflush("> Fetching '%s' to '%s'" % (remote, local))
+        code = self.transport.fetch(self.key_file, remote, local)
+        if code != 0:
+            raise RuntimeError("Failed to fetch '%s' to '%s'"
+                               % (remote, local))
+
     def exec_script(self, local, arguments=None, sudo=False,
                     working_directory=None):
         self.check_connected()
@@ -267,10 +324,13 @@ class Controller(object):
     def terminate(self, instance_name=None):
         """Terminate the running instance"""
         # Cancel any running spot instance request
-        spot_requests = self.conn.get_all_spot_instance_requests()
         if instance_name is not None:
+            spot_requests = self.conn.get_all_spot_instance_requests(
+                filters={'tag:Name': instance_name})
             spot_requests = [sr for sr in spot_requests
                              if sr.tags.get('Name') == instance_name]
+        else:
+            spot_requests = self.conn.get_all_spot_instance_requests()
         for sr in spot_requests:
             pflush('Cancelling spot request ' + sr.id)
             sr.cancel()
@@ -0,0 +1,294 @@
+"""In-process fakes of the cloud and transport backends
+
+They make it possible to exercise the controller without AWS account nor
+network access, e.g. to benchmark the overhead of the orchestration (see
+nxdd.benchmark).
+
+All the simulated durations (API latency, boot delays, spot request
+fulfilment, transfers, waits of the controller) are expressed in seconds
+of a virtual clock shared by the fakes. Each virtual second is actually
+slept time_scale real seconds: time_scale=0 only measures the overhead
+of the deployer itself.
+"""
+import itertools
+import os
+import time
+from collections import defaultdict
+
+
+class FakeClock(object):
+    """Virtual clock advanced by the simulated operations"""
+
+    def __init__(self, time_scale=0.0):
+        self.time_scale = time_scale
+        self.now = 0.0
+
+    def advance(self, seconds):
+        self.now += seconds
+        if self.time_scale > 0 and seconds > 0:
+            time.sleep(seconds * self.time_scale)
+
+
+class FakeEC2ResponseError(Exception):
+    """Error raised by the fake EC2 API, similar to boto's EC2ResponseError"""
+
+
+class FakeKeyPair(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def save(self, directory_path):
+        filepath = os.path.join(directory_path, self.name + '.pem')
+        with open(filepath, 'w') as f:
+            f.write('fake private key for %s\n' % self.name)
+        os.chmod(filepath, 0o600)
+        return True
+
+
+class FakeSecurityGroup(object):
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.rules = []
+
+    def authorize(self, ip_protocol, from_port, to_port, cidr_ip):
+        self.rules.append((ip_protocol, from_port, to_port, cidr_ip))
+        return True
+
+
+class FakeInstance(object):
+
+    def __init__(self, backend, instance_id, image_id, instance_type,
+                 key_name):
+        self.backend = backend
+        self.id = instance_id
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.key_name = key_name
+        self.dns_name = 'ec2-%s.fake.amazonaws.com' % instance_id
+        self.tags = {}
+        self.launch_time = backend.clock.now
+        self.state = 'pending'
+        self._refresh()
+
+    def _refresh(self):
+        if (self.state == 'pending' and self.backend.clock.now
+                >= self.launch_time + self.backend.boot_delay):
+            self.state = 'running'
+
+    def update(self):
+        self.backend.api_call('update')
+        self._refresh()
+        return self.state
+
+    def terminate(self):
+        self.backend.api_call('terminate')
+        self.state = 'terminated'
+
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeSpotInstanceRequest(object):
+
+    def __init__(self, backend, request_id, launch_specification):
+        self.backend = backend
+        self.id = request_id
+        self.launch_specification = launch_specification
+        self.created_time = backend.clock.now
+        self.state = 'open'
+        self.instance_id = None
+        self.tags = {}
+
+    def _refresh(self):
+        if (self.state == 'open' and self.backend.clock.now
+                >= self.created_time + self.backend.spot_delay):
+            instance = self.backend.launch_instance(
+                **self.launch_specification)
+            self.instance_id = instance.id
+            self.state = 'active'
+
+    def add_tag(self, key, value=''):
+        self.backend.api_call('add_tag')
+        self.tags[key] = value
+
+    def cancel(self):
+        self.backend.api_call('cancel')
+        if self.state == 'open':
+            self.state = 'cancelled'
+
+
+class FakeEC2Connection(object):
+    """Subset of boto's EC2Connection API used by the controller"""
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        backend = self.backend
+        backend.api_call('get_all_instances')
+        if instance_ids is not None:
+            unknown = set(instance_ids) - set(backend.instances)
+            if unknown:
+                raise FakeEC2ResponseError(
+                    'InvalidInstanceID.NotFound: %s' % ', '.join(unknown))
+            instances = [backend.instances[i] for i in instance_ids]
+        else:
+            instances = list(backend.instances.values())
+        for instance in instances:
+            instance._refresh()
+        for key, value in (filters or {}).items():
+            instances = [i for i in instances
+                         if backend.match_filter(i, key, value)]
+        return [FakeReservation([i]) for i in instances]
+
+    def get_key_pair(self, keyname):
+        self.backend.api_call('get_key_pair')
+        return self.backend.key_pairs.get(keyname)
+
+    def create_key_pair(self, key_name):
+        self.backend.api_call('create_key_pair')
+        kp = self.backend.key_pairs[key_name] = FakeKeyPair(key_name)
+        return kp
+
+    def get_all_security_groups(self, filters=None):
+        backend = self.backend
+        backend.api_call('get_all_security_groups')
+        groups = list(backend.security_groups.values())
+        for key, value in (filters or {}).items():
+            groups = [g for g in groups
+                      if backend.match_filter(g, key, value)]
+        return groups
+
+    def create_security_group(self, name, description):
+        self.backend.api_call('create_security_group')
+        sg = FakeSecurityGroup(name, description)
+        self.backend.security_groups[name] = sg
+        return sg
+
+    def run_instances(self, image_id, key_name=None, instance_type=None,
+                      security_groups=None):
+        self.backend.api_call('run_instances')
+        instance = self.backend.launch_instance(
+            image_id=image_id, key_name=key_name,
+            instance_type=instance_type)
+        return FakeReservation([instance])
+
+    def request_spot_instances(self, price, image_id, key_name=None,
+                               instance_type=None, security_groups=None):
+        backend = self.backend
+        backend.api_call('request_spot_instances')
+        request_id = 'sir-%08d' % next(backend.ids)
+        sr = FakeSpotInstanceRequest(backend, request_id, dict(
+            image_id=image_id, key_name=key_name,
+            instance_type=instance_type))
+        backend.spot_requests[request_id] = sr
+        return [sr]
+
+    def get_all_spot_instance_requests(self, request_ids=None, filters=None):
+        backend = self.backend
+        backend.api_call('get_all_spot_instance_requests')
+        if request_ids is not None:
+            requests = [backend.spot_requests[r] for r in request_ids]
+        else:
+            requests = list(backend.spot_requests.values())
+        for sr in requests:
+            sr._refresh()
+        for key, value in (filters or {}).items():
+            requests = [sr for sr in requests
+                        if backend.match_filter(sr, key, value)]
+        return requests
+
+    def create_tags(self, resource_ids, tags):
+        self.backend.api_call('create_tags')
+        for resource_id in resource_ids:
+            self.backend.instances[resource_id].tags.update(tags)
+        return True
+
+
+class FakeEC2Backend(object):
+    """In memory cloud with configurable latency and provisioning delays"""
+
+    ResponseError = FakeEC2ResponseError
+
+    def __init__(self, clock=None, api_latency=0.0, boot_delay=0.0,
+                 spot_delay=0.0):
+        self.clock = clock if clock is not None else FakeClock()
+        self.api_latency = api_latency
+        self.boot_delay = boot_delay
+        self.spot_delay = spot_delay
+        self.ids = itertools.count()
+        self.instances = {}
+        self.spot_requests = {}
+        self.key_pairs = {}
+        self.security_groups = {}
+        self.api_calls = defaultdict(int)
+
+    def connect(self, region, **ec2_params):
+        return FakeEC2Connection(self, region)
+
+    def sleep(self, delay):
+        self.clock.advance(delay)
+
+    def api_call(self, name):
+        self.api_calls[name] += 1
+        self.clock.advance(self.api_latency)
+
+    def launch_instance(self, image_id, key_name=None, instance_type=None):
+        instance_id = 'i-%08d' % next(self.ids)
+        instance = FakeInstance(self, instance_id, image_id, instance_type,
+                                key_name)
+        self.instances[instance_id] = instance
+        return instance
+
+    def match_filter(self, resource, key, value):
+        if key == 'instance-state-name':
+            return resource.state == value
+        if key == 'tag-value':
+            return value in resource.tags.values()
+        if key == 'group-name':
+            return resource.name == value
+        if key.startswith('tag:'):
+            return resource.tags.get(key[len('tag:'):]) == value
+        raise FakeEC2ResponseError('Unsupported filter: ' + key)
+
+
+class FakeTransport(object):
+    """Remote transport simulating the latency and bandwidth of ssh"""
+
+    def __init__(self, clock=None, latency=0.0, bandwidth=None):
+        self.clock = clock if clock is not None else FakeClock()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.commands = []
+        self.files = {}
+
+    def run(self, key_file, host, command):
+        self.clock.advance(self.latency)
+        self.commands.append((host, command))
+        return 0
+
+    def send(self, key_file, local, remote, rsync=True):
+        if not os.path.exists(local):
+            return 1
+        size = os.path.getsize(local)
+        duration = self.latency
+        if self.bandwidth:
+            duration += float(size) / self.bandwidth
+        self.clock.advance(duration)
+        self.files[remote] = size
+        return 0
+
+    def fetch(self, key_file, remote, local):
+        self.clock.advance(self.latency)
+        # Files are not actually stored on the fake nodes
+        return 1
+
+    def sleep(self, delay):
+        self.clock.advance(delay)
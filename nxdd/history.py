@@ -0,0 +1,129 @@
+"""Store the timings of past deployments to estimate the next ones.
+
+Each successful deployment appends an entry with the duration of its
+phases, the instance type, the Nuxeo distribution, whether the instance
+was created by the deployment and whether Nuxeo was already installed.
+Estimates are the median of the matching past entries, falling back to
+other instance types or distributions when the history is too short but
+never mixing created and reused instances nor fresh installs and
+upgrades.
+"""
+import os
+import time
+
+from nxdd.journal import load_json, save_json
+
+MAX_ENTRIES = 200
+
+# Criteria used to match past entries, from the most to the least specific
+FALLBACKS = [
+    ('same instance type and distribution', ('instance_type', 'distribution')),
+    ('same instance type', ('instance_type',)),
+    ('any instance type', ()),
+]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return None
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def state_criterion(phase, created, installed):
+    """The agent depends on the existing Nuxeo installation, the other
+    phases on whether the instance is created"""
+    if phase == 'agent' or phase.startswith('agent:'):
+        return {'installed': installed}
+    return {'created': created}
+
+
+def has_phase(phase):
+    """Predicate selecting the entries that recorded phase"""
+    return lambda entry: phase in entry['phases']
+
+
+def has_upload(entry):
+    """Predicate selecting the entries with a measured upload throughput"""
+    return entry.get('upload_duration', 0) > 0
+
+
+class DeploymentHistory(object):
+    """Timings of the past deployments stored in a local JSON file"""
+
+    def __init__(self, filepath):
+        self.filepath = os.path.expanduser(filepath)
+        self.entries = []
+        self.load()
+
+    def load(self):
+        self.entries = load_json(self.filepath, {}).get('entries', [])
+
+    def save(self):
+        save_json(self.filepath, {'entries': self.entries})
+
+    def record(self, instance_type, distribution, created, installed,
+               phases, upload_bytes=0, upload_duration=0.0):
+        """Append the phase durations (in seconds) of a deployment
+
+        created tells whether the instance was created by the deployment
+        and installed whether Nuxeo was installed before running the agent
+        (None if unknown).
+        """
+        # Deployments may run in parallel for a long time: reload to keep the
+        # entries recorded by the other processes since the startup
+        self.load()
+        self.entries.append({
+            'timestamp': time.time(),
+            'instance_type': instance_type,
+            'distribution': distribution,
+            'created': created,
+            'installed': installed,
+            'phases': phases,
+            'upload_bytes': upload_bytes,
+            'upload_duration': upload_duration,
+        })
+        self.entries = self.entries[-MAX_ENTRIES:]
+        self.save()
+
+    def matching_entries(self, instance_type, distribution, usable=None,
+                         **state):
+        """Most specific non empty list of usable entries matching the criteria
+
+        The state criteria (created or installed) are always enforced.
+        usable is an optional predicate filtering the entries that can be
+        used for the estimate, so that a level without any usable entry
+        falls back to the next one. Return the entries along with a
+        description of the fallback level or None if no entry matches.
+        """
+        context = dict(instance_type=instance_type, distribution=distribution)
+        for description, keys in FALLBACKS:
+            criterion = dict((k, context[k]) for k in keys)
+            criterion.update(state)
+            entries = [e for e in self.entries
+                       if all(e.get(k) == v for k, v in criterion.items())
+                       and (usable is None or usable(e))]
+            if entries:
+                return entries, description
+        return [], None
+
+    def estimate(self, phase, instance_type, distribution, created,
+                 installed):
+        """Median past duration of phase or None if never recorded"""
+        entries, description = self.matching_entries(
+            instance_type, distribution, has_phase(phase),
+            **state_criterion(phase, created, installed))
+        return median([e['phases'][phase] for e in entries])
+
+    def estimate_upload(self, nbytes, instance_type, distribution, created):
+        """Estimate the time to upload nbytes from the past throughputs"""
+        entries, description = self.matching_entries(
+            instance_type, distribution, has_upload, created=created)
+        throughput = median([e['upload_bytes'] / e['upload_duration']
+                             for e in entries])
+        if throughput is None:
+            return None
+        return nbytes / throughput
@@ -0,0 +1,160 @@
+"""Persist the completed phases of a deployment to resume failed runs.
+
+Each phase is recorded along with a digest of its inputs. On the next run
+completed phases whose inputs did not change are skipped, up to the first
+phase that is either missing from the journal or invalidated: all the
+following phases are then executed again.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from nxdd.controller import pflush
+
+
+def digest(*items):
+    """Compute a stable hash of JSON serializable items"""
+    payload = json.dumps(items, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def file_digest(path, blocksize=1024 * 1024):
+    """Compute the hash of the content of a file or folder"""
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(root, filename)
+                h.update(os.path.relpath(filepath, path).encode('utf-8'))
+                h.update(file_digest(filepath).encode('utf-8'))
+        return h.hexdigest()
+
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_json(filepath, default):
+    """Load a JSON file, return default if missing or corrupted"""
+    if not os.path.exists(filepath):
+        return default
+    try:
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # Corrupted file (e.g. interrupted write): start from scratch
+        return default
+
+
+def save_json(filepath, data):
+    """Atomically replace filepath with the JSON serialization of data"""
+    folder = os.path.dirname(filepath)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    # Write to a temporary file of the same folder first so that an
+    # interrupted run never leaves a truncated file behind. The name is
+    # unique so that concurrent processes never write to the same one.
+    fd, tmp_filepath = tempfile.mkstemp(
+        dir=folder or '.', prefix=os.path.basename(filepath) + '.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.unlink(tmp_filepath)
+
+
+class DeploymentJournal(object):
+    """Ordered record of the completed phases of a deployment on an instance"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.phases = {}
+        # Set by run once a phase is executed: all the following phases need
+        # to be executed again
+        self.invalidated = False
+        self.load()
+
+    @classmethod
+    def for_instance(cls, journal_folder, instance_name):
+        journal_folder = os.path.expanduser(journal_folder)
+        return cls(os.path.join(journal_folder,
+                                instance_name + '.journal.json'))
+
+    def load(self):
+        self.phases = load_json(self.filepath, {}).get('phases', {})
+
+    def save(self):
+        save_json(self.filepath, {'phases': self.phases})
+
+    def clear(self):
+        """Forget all the completed phases"""
+        self.phases = {}
+        self.invalidated = False
+        if os.path.exists(self.filepath):
+            os.unlink(self.filepath)
+
+    def is_completed(self, phase, inputs_digest):
+        """Check whether phase was completed with the given inputs
+
+        This does not take the previous phases into account: see
+        skipped_phases and run.
+        """
+        record = self.phases.get(phase)
+        return record is not None and record.get('digest') == inputs_digest
+
+    def skipped_phases(self, phases):
+        """Names of the phases that run would skip
+
+        phases is the ordered list of (phase, inputs digest) pairs: only the
+        completed phases preceding the first missing or invalidated one are
+        skipped.
+        """
+        skipped = []
+        for phase, inputs_digest in phases:
+            if not self.is_completed(phase, inputs_digest):
+                break
+            skipped.append(phase)
+        return skipped
+
+    def get(self, phase):
+        """Outputs recorded for a completed phase"""
+        record = self.phases.get(phase)
+        if record is None:
+            return None
+        return record.get('outputs')
+
+    def record(self, phase, inputs_digest, outputs=None, duration=None):
+        self.phases[phase] = {
+            'digest': inputs_digest,
+            'outputs': outputs,
+            'completed_at': time.time(),
+            'duration': duration,
+        }
+        self.save()
+
+    def run(self, phase, inputs_digest, func, *args, **kwargs):
+        """Execute func unless phase is already completed for those inputs
+
+        Phases must be run in order: once a phase is executed, all the
+        following ones are executed as well. func should return None or JSON
+        serializable outputs that are returned as is on later runs when the
+        phase is skipped.
+        """
+        if not self.invalidated and self.is_completed(phase, inputs_digest):
+            pflush("Skipping phase '%s' completed by a previous run" % phase)
+            return self.get(phase)
+        self.invalidated = True
+        tick = time.time()
+        outputs = func(*args, **kwargs)
+        self.record(phase, inputs_digest, outputs, time.time() - tick)
+        return outputs
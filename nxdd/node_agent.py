@@ -6,12 +6,22 @@ import json
 import socket
 import sys
 import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 
 HOSTNAME = socket.gethostname()
 NUXEO_CONF = '/etc/nuxeo/nuxeo.conf'
 NUXEO_DATA = '/var/lib/nuxeo/data'
 NUXEO_HOME = '/var/lib/nuxeo/server'
 NUXEO_CONFIG_DIR = NUXEO_HOME + '/nxserver/config'
+# Compact per step summary fetched by the controller
+RESOURCE_SUMMARY_FILE = 'resource-summary.json'
+# Raw samples kept on the node for troubleshooting
+RESOURCE_SAMPLES_FILE = 'resource-samples.json'
+# Seconds between two samples of the node resources
+SAMPLE_INTERVAL = 1.0
 
 
 # TODO: turn this into a template to make it possible to deploy several
@@ -210,9 +220,269 @@ def check_install_vhost(**ignored):
     cmd("apache2ctl -k graceful")
 
 
+def read_cpu_counters():
+    """Return (busy, iowait, steal, total) jiffies of all the CPUs
+
+    Time stolen by the hypervisor for other virtual machines is not counted
+    as busy.
+    """
+    with open('/proc/stat', 'rb') as f:
+        fields = f.readline().split()[1:]
+    values = [int(v) for v in fields[:8]]
+    idle, iowait = values[3], values[4]
+    steal = values[7] if len(values) > 7 else 0
+    total = sum(values)
+    return total - idle - iowait - steal, iowait, steal, total
+
+
+def read_cpu_count():
+    """Return the number of CPUs listed in /proc/stat"""
+    count = 0
+    with open('/proc/stat', 'rb') as f:
+        for line in f:
+            if line.startswith(b'cpu') and line[3:4].isdigit():
+                count += 1
+    return max(count, 1)
+
+
+def read_memory_used():
+    """Return the used memory in kB (excluding buffers and page cache)"""
+    meminfo = {}
+    with open('/proc/meminfo', 'rb') as f:
+        for line in f:
+            k, v = line.decode('ascii').split(':', 1)
+            meminfo[k] = int(v.split()[0])
+    if 'MemAvailable' in meminfo:
+        available = meminfo['MemAvailable']
+    else:
+        # Older kernels such as the one shipped with precise
+        available = (meminfo['MemFree'] + meminfo.get('Buffers', 0)
+                     + meminfo.get('Cached', 0))
+    return meminfo['MemTotal'] - available
+
+
+def read_disk_counters():
+    """Return (read, written) bytes of the physical disks"""
+    if os.path.isdir('/sys/block'):
+        disks = set(d for d in os.listdir('/sys/block')
+                    if not d.startswith(('loop', 'ram')))
+    else:
+        disks = None
+    read = written = 0
+    with open('/proc/diskstats', 'rb') as f:
+        for line in f:
+            fields = line.decode('ascii').split()
+            if disks is not None and fields[2] not in disks:
+                continue
+            # Sectors are always 512 bytes in /proc/diskstats
+            read += int(fields[5]) * 512
+            written += int(fields[9]) * 512
+    return read, written
+
+
+def read_network_counters():
+    """Return (received, transmitted) bytes on non loopback interfaces"""
+    received = transmitted = 0
+    with open('/proc/net/dev', 'rb') as f:
+        for line in f:
+            line = line.decode('ascii')
+            if ':' not in line:
+                # headers
+                continue
+            interface, data = line.split(':', 1)
+            if interface.strip() == 'lo':
+                continue
+            fields = data.split()
+            received += int(fields[0])
+            transmitted += int(fields[8])
+    return received, transmitted
+
+
+# Fields of the samples: the step name followed by the values returned by
+# read_counters
+SAMPLE_FIELDS = ('step', 'time', 'cpu_busy', 'cpu_iowait', 'cpu_steal',
+                 'cpu_total', 'memory_used', 'disk_read', 'disk_written',
+                 'net_received', 'net_transmitted')
+# Cumulative counters accumulated per step
+CUMULATIVE_FIELDS = ('cpu_busy', 'cpu_iowait', 'cpu_steal', 'cpu_total',
+                     'disk_read', 'disk_written', 'net_received',
+                     'net_transmitted')
+
+
+def read_counters():
+    cpu_busy, cpu_iowait, cpu_steal, cpu_total = read_cpu_counters()
+    disk_read, disk_written = read_disk_counters()
+    net_received, net_transmitted = read_network_counters()
+    return (time.time(), cpu_busy, cpu_iowait, cpu_steal, cpu_total,
+            read_memory_used(), disk_read, disk_written, net_received,
+            net_transmitted)
+
+
+class ResourceSampler(threading.Thread):
+    """Sample the node resources in the background during the deployment
+
+    Raw samples are kept in a bounded ring buffer while the resources
+    consumed between two consecutive samples are accumulated for the step
+    running when the second sample is taken.
+
+    CPU usages are percentages of a single CPU as reported by top: a step
+    saturating one core is at 100% whatever the number of CPUs of the node.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, max_samples=600):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self.steps = []
+        self.current_step = None
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.enabled = os.path.exists('/proc/stat')
+        if not self.enabled:
+            pflush('No /proc filesystem: resource sampling disabled')
+        self.cpus = read_cpu_count() if self.enabled else 1
+
+    def sample(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            sample = (self.current_step,) + read_counters()
+            if self.samples and self.current_step is not None:
+                previous = dict(zip(SAMPLE_FIELDS, self.samples[-1]))
+                current = dict(zip(SAMPLE_FIELDS, sample))
+                totals = self.totals.get(self.current_step)
+                if totals is None:
+                    totals = dict((k, 0) for k in CUMULATIVE_FIELDS)
+                    totals['memory_max'] = 0
+                    self.totals[self.current_step] = totals
+                for k in CUMULATIVE_FIELDS:
+                    totals[k] += current[k] - previous[k]
+                totals['memory_max'] = max(totals['memory_max'],
+                                           current['memory_used'])
+            self.samples.append(sample)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    @contextmanager
+    def step(self, name):
+        """Attribute the resources consumed in the block to step name"""
+        # Sample at step boundaries for accurate attribution
+        self.sample()
+        self.current_step = name
+        tick = time.time()
+        try:
+            yield
+        finally:
+            self.sample()
+            self.current_step = None
+            self.steps.append((name, time.time() - tick))
+
+    def summary(self):
+        steps = []
+        with self.lock:
+            for name, duration in self.steps:
+                totals = self.totals.get(name)
+                step = {'name': name, 'duration': duration}
+                if totals is not None:
+                    # Percentages of a single CPU
+                    scale = 100.0 * self.cpus / max(totals['cpu_total'], 1)
+                    step.update(
+                        cpu_percent=scale * totals['cpu_busy'],
+                        iowait_percent=scale * totals['cpu_iowait'],
+                        steal_percent=scale * totals['cpu_steal'],
+                        memory_max_kb=totals['memory_max'],
+                        disk_read_bytes=totals['disk_read'],
+                        disk_written_bytes=totals['disk_written'],
+                        net_received_bytes=totals['net_received'],
+                        net_transmitted_bytes=totals['net_transmitted'],
+                    )
+                    step['bound'] = guess_bound(step)
+                steps.append(step)
+        return {'interval': self.interval, 'cpus': self.cpus, 'steps': steps}
+
+    def dump(self, summary_filepath, samples_filepath, **info):
+        summary = self.summary()
+        summary.update(info)
+        with open(summary_filepath, 'w') as f:
+            json.dump(summary, f)
+        with self.lock:
+            samples = [list(s) for s in self.samples]
+        with open(samples_filepath, 'w') as f:
+            json.dump({'interval': self.interval, 'fields': SAMPLE_FIELDS,
+                       'samples': samples}, f)
+
+
+def guess_bound(step):
+    """Guess which resource was the bottleneck of a step
+
+    The CPU thresholds apply to a single CPU so that single threaded steps
+    are detected on nodes with several CPUs.
+    """
+    if step['iowait_percent'] >= 20:
+        return 'disk'
+    if step['cpu_percent'] >= 70:
+        return 'cpu'
+    network_rate = (step['net_received_bytes']
+                    + step['net_transmitted_bytes']) / max(step['duration'], 1)
+    if network_rate >= 1024 * 1024:
+        return 'network'
+    # Mostly idle: waiting for a remote service or a sleeping process
+    return 'idle'
+
+
+def format_resource_summary(summary):
+    """Compact human readable table of the resources used by each step"""
+    lines = ['cpu%%, iowait%% and steal%% of a single CPU (%s CPU(s) on the'
+             ' node)' % summary.get('cpus', '?')]
+    lines.append('%-20s %9s %6s %8s %7s %8s %14s %14s  %s' % (
+        'step', 'duration', 'cpu%', 'iowait%', 'steal%', 'mem(MB)',
+        'disk r/w(MB)', 'net rx/tx(MB)', 'bound'))
+    for step in summary['steps']:
+        if 'cpu_percent' not in step:
+            lines.append('%-20s %8.1fs' % (step['name'], step['duration']))
+            continue
+        lines.append('%-20s %8.1fs %6.1f %8.1f %7.1f %8d %14s %14s  %s' % (
+            step['name'], step['duration'], step['cpu_percent'],
+            step['iowait_percent'], step.get('steal_percent', 0),
+            step['memory_max_kb'] // 1024,
+            '%d/%d' % (step['disk_read_bytes'] // 2 ** 20,
+                       step['disk_written_bytes'] // 2 ** 20),
+            '%d/%d' % (step['net_received_bytes'] // 2 ** 20,
+                       step['net_transmitted_bytes'] // 2 ** 20),
+            step['bound']))
+    return "\n".join(lines)
+
+
+# Ordered steps run by the agent
+DEPLOYMENT_STEPS = (check_install_nuxeo, setup_nuxeo, check_install_vhost)
+
+
 if __name__ == "__main__":
     with open(sys.argv[1], 'rb') as f:
         parameters = json.load(f)
-    check_install_nuxeo(**parameters)
-    setup_nuxeo(**parameters)
-    check_install_vhost(**parameters)
+    # Report whether Nuxeo is upgraded or installed from scratch
+    nuxeo_installed = os.access(NUXEO_HOME + '/bin/nuxeoctl', os.X_OK)
+    sampler = ResourceSampler()
+    sampler.start()
+    try:
+        for step in DEPLOYMENT_STEPS:
+            with sampler.step(step.__name__):
+                step(**parameters)
+    finally:
+        sampler.stop()
+        try:
+            sampler.dump(RESOURCE_SUMMARY_FILE, RESOURCE_SAMPLES_FILE,
+                         nuxeo_installed=nuxeo_installed)
+        except IOError:
+            # The controller will not be able to report the summary
+            pflush(format_resource_summary(sampler.summary()))
@@ -0,0 +1,194 @@
+"""Plan a deployment without changing anything on the cloud or the node.
+
+The plan lists the ordered phases that the command line would run, the
+phases skipped because they were completed by a previous failed run and
+the bytes to transfer. Durations are estimated from the history of past
+deployments (see nxdd.history).
+"""
+import os
+
+from nxdd.commandline import deployment_phases, get_connect_digest
+from nxdd.history import has_phase
+from nxdd.node_agent import DEPLOYMENT_STEPS, NUXEO_HOME
+
+# Status of a remote command exiting with code 1, as returned by os.system
+EXIT_STATUS_1 = 1 << 8
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    return '%dmin %02ds' % (seconds // 60, seconds % 60)
+
+
+def format_size(nbytes):
+    if nbytes < 1024:
+        return '%dB' % nbytes
+    if nbytes < 1024 ** 2:
+        return '%.1fkB' % (nbytes / 1024.0)
+    return '%.1fMB' % (nbytes / 1024.0 ** 2)
+
+
+def find_instance(ctl, options, journal):
+    """Instance that the deployment would reuse or None"""
+    previous = journal.get('connect') or {}
+    if (options.resume
+            and journal.is_completed('connect', get_connect_digest(options))):
+        instance = ctl.get_instance(previous['instance_id'])
+        if instance is not None and options.instance_name in (
+                instance.tags.get('Name'), instance.tags.get('name')):
+            return instance
+    return ctl.get_running_instance(options.instance_name)
+
+
+def probe_nuxeo_installed(ctl, instance):
+    """Check whether Nuxeo is installed on the node, None if unknown"""
+    key_file = ctl.get_local_key_file()
+    if key_file is None or not os.path.exists(key_file):
+        return None
+    ctl.key_file = key_file
+    ctl.attach(instance)
+    # Use the transport directly to keep the command out of the plan
+    code = ctl.transport.run(key_file, ctl.ssh_host,
+                             'test -x %s/bin/nuxeoctl' % NUXEO_HOME)
+    if code == 0:
+        return True
+    if code == EXIT_STATUS_1:
+        return False
+    # e.g. 255 when ssh itself failed
+    return None
+
+
+def make_plan(ctl, options, journal, history):
+    """Ordered list of the actions of the deployment with estimates"""
+    steps = []
+
+    # Connection to the instance
+    instance = find_instance(ctl, options, journal)
+    key_file = ctl.get_local_key_file()
+    notes = []
+    if key_file is not None and not os.path.exists(key_file):
+        notes.append('create keypair %s' % options.keypair_name)
+    if instance is None:
+        created = True
+        installed = False
+        instance_id = None
+        if options.bid is None or options.bid <= 0:
+            action = 'Create on demand %s instance' % options.instance_type
+        else:
+            action = 'Create spot %s instance at $%0.3f' % (
+                options.instance_type, options.bid)
+    else:
+        instance_id = instance.id
+        action = 'Reuse running instance %s at %s' % (instance.id,
+                                                      instance.dns_name)
+        # Same rule as the deployment: an instance created by a previous
+        # failed run is still considered as created
+        previous = journal.get('connect') or {}
+        created = (previous.get('instance_id') == instance.id
+                   and previous.get('created', False))
+        installed = probe_nuxeo_installed(ctl, instance)
+        if installed is None:
+            installed = not created
+            notes.append('could not check Nuxeo installation, assuming %s'
+                         % ('installed' if installed else 'not installed'))
+        else:
+            notes.append('Nuxeo %s' % ('already installed' if installed
+                                       else 'not installed'))
+
+    def estimate(phase):
+        return history.estimate(phase, options.instance_type,
+                                options.nuxeo_distribution, created,
+                                installed)
+
+    steps.append(dict(phase='connect', action=action, notes=notes, bytes=0,
+                      skipped=False, estimate=estimate('connect'),
+                      details=[]))
+
+    phases = deployment_phases(ctl, options, instance_id)
+    if options.resume:
+        skipped = journal.skipped_phases(
+            [(phase['name'], phase['digest']) for phase in phases])
+    else:
+        # All the phases would be run again
+        skipped = []
+    for phase in phases:
+        step = dict(phase=phase['name'], action=phase['description'],
+                    notes=[], bytes=phase['bytes'], details=[],
+                    skipped=phase['name'] in skipped)
+        if step['skipped']:
+            step['notes'].append('completed by a previous run')
+            step['estimate'] = 0
+        elif phase['name'].startswith('upload:'):
+            step['estimate'] = history.estimate_upload(
+                phase['bytes'], options.instance_type,
+                options.nuxeo_distribution, created)
+        else:
+            step['estimate'] = estimate(phase['name'])
+        if phase['name'] == 'agent' and options.deployment_script is None:
+            step['details'] = [
+                (f.__name__, estimate('agent:' + f.__name__))
+                for f in DEPLOYMENT_STEPS]
+        steps.append(step)
+
+    # Describe which past deployments the estimates of the connect and agent
+    # phases are based on
+    bases = []
+    for label, phase, state in [
+            ('Instance' + (' creation' if created else ' reuse'),
+             'connect', {'created': created}),
+            ('Nuxeo ' + ('upgrade' if installed else 'installation'),
+             'agent', {'installed': installed})]:
+        entries, description = history.matching_entries(
+            options.instance_type, options.nuxeo_distribution,
+            has_phase(phase), **state)
+        bases.append((label, len(entries), description))
+
+    return dict(instance_name=options.instance_name,
+                instance_type=options.instance_type,
+                distribution=options.nuxeo_distribution,
+                created=created, installed=installed, steps=steps,
+                bases=bases)
+
+
+def format_plan(plan):
+    lines = ["Deployment plan for '%s' (%s, '%s'):" % (
+        plan['instance_name'], plan['instance_type'], plan['distribution'])]
+    total = 0
+    total_bytes = 0
+    unknown = 0
+    for i, step in enumerate(plan['steps']):
+        action = step['action']
+        if step['bytes'] and not step['skipped']:
+            action += ' (%s)' % format_size(step['bytes'])
+            total_bytes += step['bytes']
+        if step['skipped']:
+            action = 'Skip: ' + action
+        lines.append('%3d. %-66s ~%s' % (
+            i + 1, action, format_duration(step['estimate'])))
+        for note in step['notes']:
+            lines.append('       %s' % note)
+        if not step['skipped']:
+            for name, estimate in step['details']:
+                lines.append('       %-64s ~%s' % (
+                    name, format_duration(estimate)))
+        if step['estimate'] is None:
+            unknown += 1
+        else:
+            total += step['estimate']
+
+    lines.append('Bytes to transfer: %s' % format_size(total_bytes))
+    summary = 'Estimated duration: %s' % format_duration(total)
+    if unknown:
+        summary += ' (%d phases without history)' % unknown
+    lines.append(summary)
+    for label, count, description in plan['bases']:
+        if count:
+            lines.append('  %s timings from %d past deployments (%s)'
+                         % (label, count, description))
+        else:
+            lines.append('  %s timings: no past deployment' % label)
+    return "\n".join(lines)
@@ -0,0 +1,98 @@
+"""Check the estimates computed from the history of past deployments"""
+import os
+import shutil
+import tempfile
+
+from nxdd.history import DeploymentHistory
+
+
+def make_history():
+    folder = tempfile.mkdtemp(prefix='nxdd-test-')
+    history = DeploymentHistory(os.path.join(folder, 'history.json'))
+    history.record('m1.medium', 'precise releases', True, False,
+                   {'connect': 200, 'agent': 900})
+    history.record('m1.medium', 'precise releases', False, True,
+                   {'connect': 10, 'agent': 300})
+    return folder, history
+
+
+def test_estimates_never_mix_created_and_reused_instances():
+    folder, history = make_history()
+    try:
+        assert history.estimate('connect', 'm1.medium', 'precise releases',
+                                True, True) == 200
+        assert history.estimate('connect', 'm1.large', 'precise releases',
+                                False, True) == 10
+        # The agent depends on the existing Nuxeo installation only
+        assert history.estimate('agent', 'm1.medium', 'precise releases',
+                                False, False) == 900
+        assert history.estimate('agent', 'm1.medium', 'precise releases',
+                                True, None) is None
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_matching_entries_describe_the_fallback_level():
+    folder, history = make_history()
+    try:
+        entries, description = history.matching_entries(
+            'm1.medium', 'precise releases', created=True)
+        assert len(entries) == 1
+        assert description == 'same instance type and distribution'
+        entries, description = history.matching_entries(
+            'm1.medium', 'precise snapshots', created=True)
+        assert description == 'same instance type'
+        entries, description = history.matching_entries(
+            'm1.large', 'precise snapshots', created=True)
+        assert description == 'any instance type'
+
+        # Reloaded from disk
+        history = DeploymentHistory(history.filepath)
+        assert len(history.entries) == 2
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_parallel_deployments_keep_all_entries():
+    folder, history = make_history()
+    try:
+        # Both deployments load the history at startup
+        first = DeploymentHistory(history.filepath)
+        second = DeploymentHistory(history.filepath)
+        first.record('m1.large', 'precise releases', True, False,
+                     {'connect': 100})
+        second.record('m1.small', 'precise releases', True, False,
+                      {'connect': 300})
+        entries = DeploymentHistory(history.filepath).entries
+        assert [e['instance_type'] for e in entries] == [
+            'm1.medium', 'm1.medium', 'm1.large', 'm1.small']
+        # No temporary file left behind
+        assert os.listdir(folder) == ['history.json']
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_fallback_skips_the_levels_without_usable_entries():
+    folder, history = make_history()
+    try:
+        history.record('m1.large', 'precise releases', True, False,
+                       {'connect': 100, 'agent': 600},
+                       upload_bytes=1000, upload_duration=1.0)
+        # Upload skipped by a resumed run
+        history.record('m1.medium', 'precise releases', True, False,
+                       {'connect': 150, 'agent': 900},
+                       upload_bytes=0, upload_duration=0)
+        # Custom deployment script without agent steps
+        history.record('m1.small', 'precise releases', True, False,
+                       {'connect': 150})
+        assert history.estimate_upload(2000, 'm1.medium', 'precise releases',
+                                       True) == 2.0
+        assert history.estimate('agent', 'm1.small', 'precise releases',
+                                True, False) == 900
+        entries, description = history.matching_entries(
+            'm1.medium', 'precise snapshots', lambda e: e['upload_bytes'],
+            created=True)
+        assert len(entries) == 1
+        assert description == 'any instance type'
+    finally:
+        shutil.rmtree(folder)
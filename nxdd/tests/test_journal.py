@@ -0,0 +1,183 @@
+"""Check which deployment phases are resumed after a failed run"""
+import os
+import shutil
+import sys
+import tempfile
+
+from nxdd import commandline
+from nxdd.fakes import FakeClock, FakeEC2Backend, FakeTransport
+from nxdd.journal import DeploymentJournal
+
+
+class FailingTransport(FakeTransport):
+    """Fake transport failing the commands and transfers matching fail_on"""
+
+    def __init__(self, clock=None):
+        FakeTransport.__init__(self, clock)
+        self.fail_on = None
+        self.fail_status = 1
+        self.sent = []
+
+    def run(self, key_file, host, command):
+        if self.fail_on is not None and self.fail_on in command:
+            return self.fail_status
+        return FakeTransport.run(self, key_file, host, command)
+
+    def send(self, key_file, local, remote, rsync=True):
+        if self.fail_on is not None and self.fail_on in remote:
+            return 1
+        self.sent.append(remote.split(':', 1)[1])
+        return FakeTransport.send(self, key_file, local, remote, rsync=rsync)
+
+
+class Deployment(object):
+    """Run the command line against the fakes in a temporary folder"""
+
+    def __init__(self):
+        self.folder = tempfile.mkdtemp(prefix='nxdd-test-')
+        self.package = os.path.join(self.folder, 'my-package-1.0.zip')
+        self.write_package(b'package content')
+        clock = FakeClock()
+        self.cloud = FakeEC2Backend(clock)
+        self.transport = FailingTransport(clock)
+
+    def write_package(self, content):
+        with open(self.package, 'wb') as f:
+            f.write(content)
+
+    def run(self, *args):
+        self.transport.commands = []
+        self.transport.sent = []
+        stdout = sys.stdout
+        output_filepath = os.path.join(self.folder, 'output.txt')
+        try:
+            with open(output_filepath, 'w') as output:
+                sys.stdout = output
+                return commandline.main([
+                    '--instance-name', 'demo',
+                    '--keys-folder', self.folder,
+                    '--package', self.package,
+                ] + list(args), cloud=self.cloud, transport=self.transport)
+        finally:
+            sys.stdout = stdout
+            with open(output_filepath, 'r') as output:
+                self.output = output.read()
+
+    def fail(self, fail_on):
+        self.transport.fail_on = fail_on
+        try:
+            self.run()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('Deployment did not fail on ' + fail_on)
+        finally:
+            self.transport.fail_on = None
+
+    def ran_agent(self):
+        return any('./node_agent.py' in c and 'chmod' not in c
+                   for host, c in self.transport.commands)
+
+    def created_directory(self):
+        return any(c.startswith('sudo mkdir')
+                   for host, c in self.transport.commands)
+
+    def cleanup(self):
+        shutil.rmtree(self.folder)
+
+
+def test_resume_after_agent_failure():
+    d = Deployment()
+    try:
+        d.fail('./node_agent.py')
+        assert d.run() == 0
+        # Same instance, only the agent is run again
+        assert len(d.cloud.instances) == 1
+        assert not d.created_directory()
+        assert d.transport.sent == ['/home/ubuntu/demo/node_agent.py']
+        assert d.ran_agent()
+    finally:
+        d.cleanup()
+
+
+def test_resume_after_upload_failure():
+    d = Deployment()
+    try:
+        d.fail('my-package-1.0.zip')
+        assert not d.ran_agent()
+        assert d.run() == 0
+        assert len(d.cloud.instances) == 1
+        assert not d.created_directory()
+        assert d.transport.sent == [
+            '/home/ubuntu/demo/my-package-1.0.zip',
+            '/home/ubuntu/demo/demo-deployer-params.json',
+            '/home/ubuntu/demo/node_agent.py',
+        ]
+        assert d.ran_agent()
+    finally:
+        d.cleanup()
+
+
+def test_changed_package_invalidates_following_phases():
+    d = Deployment()
+    try:
+        d.fail('./node_agent.py')
+        d.write_package(b'new package content')
+        assert d.run() == 0
+        assert not d.created_directory()
+        # The parameters did not change but follow the invalidated upload
+        assert d.transport.sent == [
+            '/home/ubuntu/demo/my-package-1.0.zip',
+            '/home/ubuntu/demo/demo-deployer-params.json',
+            '/home/ubuntu/demo/node_agent.py',
+        ]
+    finally:
+        d.cleanup()
+
+
+def test_no_resume_runs_all_phases():
+    d = Deployment()
+    try:
+        d.fail('./node_agent.py')
+        assert d.run('--no-resume') == 0
+        assert d.created_directory()
+        assert len(d.transport.sent) == 3
+    finally:
+        d.cleanup()
+
+
+def test_successful_deployment_clears_journal():
+    d = Deployment()
+    try:
+        assert d.run() == 0
+        assert d.run() == 0
+        assert d.created_directory()
+        assert len(d.transport.sent) == 3
+        assert len(d.cloud.instances) == 1
+    finally:
+        d.cleanup()
+
+
+def test_is_completed_has_no_side_effect():
+    folder = tempfile.mkdtemp(prefix='nxdd-test-')
+    try:
+        journal = DeploymentJournal(os.path.join(folder, 'j.json'))
+        journal.record('a', '1')
+        journal.record('b', '2')
+        assert not journal.is_completed('a', 'changed')
+        assert not journal.is_completed('missing', '0')
+        assert journal.is_completed('b', '2')
+        assert journal.skipped_phases([('a', '1'), ('b', '2')]) == ['a', 'b']
+        assert journal.skipped_phases([('a', '0'), ('b', '2')]) == []
+
+        calls = []
+        journal.run('a', '1', calls.append, 'a')
+        journal.run('b', '2', calls.append, 'b')
+        assert calls == []
+
+        # Once a phase is executed the following ones are executed too
+        journal.run('a', 'changed', calls.append, 'a')
+        journal.run('b', '2', calls.append, 'b')
+        assert calls == ['a', 'b']
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,82 @@
+"""Check the attribution of the node resources to the deployment steps"""
+from nxdd import node_agent
+from nxdd.node_agent import ResourceSampler, format_resource_summary
+
+MB = 1024 * 1024
+
+
+def sample_steps(counters, cpus=2):
+    """Run the steps 'compile' and 'download' with synthetic counters
+
+    counters is the list of the values returned by read_counters at the
+    start and the end of each step.
+    """
+    values = iter(counters)
+    read_counters = node_agent.read_counters
+    node_agent.read_counters = lambda: next(values)
+    try:
+        sampler = ResourceSampler()
+        sampler.enabled = True
+        sampler.cpus = cpus
+        for name in ('compile', 'download'):
+            with sampler.step(name):
+                pass
+    finally:
+        node_agent.read_counters = read_counters
+    return dict((step['name'], step) for step in sampler.summary()['steps'])
+
+
+def test_resources_are_attributed_to_the_running_step():
+    # time, cpu busy, iowait, steal and total jiffies, memory, disk read and
+    # written, network received and transmitted
+    steps = sample_steps([
+        (0, 1000, 100, 10, 5000, 100, 0, 0, 0, 0),
+        (10, 1950, 100, 50, 7000, 300, 4 * MB, 8 * MB, MB, 0),
+        # Not attributed: between the two steps
+        (11, 2950, 500, 50, 8000, 200, 5 * MB, 9 * MB, MB, 0),
+        (21, 3050, 600, 50, 10000, 250, 5 * MB, 9 * MB, 51 * MB, MB),
+    ])
+
+    compiling = steps['compile']
+    # Single threaded step on a node with 2 CPUs
+    assert compiling['cpu_percent'] == 95.0
+    assert compiling['iowait_percent'] == 0.0
+    # Steal time is not counted as busy
+    assert compiling['steal_percent'] == 4.0
+    assert compiling['memory_max_kb'] == 300
+    assert compiling['disk_read_bytes'] == 4 * MB
+    assert compiling['disk_written_bytes'] == 8 * MB
+    assert compiling['net_received_bytes'] == MB
+    assert compiling['bound'] == 'cpu'
+
+    download = steps['download']
+    assert download['cpu_percent'] == 10.0
+    assert download['iowait_percent'] == 10.0
+    assert download['memory_max_kb'] == 250
+    assert download['disk_read_bytes'] == 0
+    assert download['net_received_bytes'] == 50 * MB
+    assert download['net_transmitted_bytes'] == MB
+    assert download['bound'] == 'network'
+
+
+def test_iowait_means_disk_bound():
+    steps = sample_steps([
+        (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        (10, 100, 600, 0, 2000, 0, 0, 500 * MB, 0, 0),
+        (10, 100, 600, 0, 2000, 0, 0, 500 * MB, 0, 0),
+        (20, 100, 600, 0, 4000, 0, 0, 500 * MB, 0, 0),
+    ], cpus=4)
+    assert steps['compile']['cpu_percent'] == 20.0
+    assert steps['compile']['iowait_percent'] == 120.0
+    assert steps['compile']['bound'] == 'disk'
+    assert steps['download']['cpu_percent'] == 0.0
+    assert steps['download']['bound'] == 'idle'
+
+
+def test_format_step_without_samples():
+    output = format_resource_summary({'steps': [
+        {'name': 'setup_nuxeo', 'duration': 12.5},
+    ]})
+    lines = output.splitlines()
+    assert 'steal%' in lines[1]
+    assert lines[2].split() == ['setup_nuxeo', '12.5s']
@@ -0,0 +1,77 @@
+"""Check the plan of a deployment against the fakes"""
+from nxdd.tests.test_journal import Deployment
+
+
+def plan(d, probe_status=None):
+    if probe_status is not None:
+        d.transport.fail_on = 'test -x'
+        d.transport.fail_status = probe_status
+    try:
+        assert d.run('--plan') == 0
+    finally:
+        d.transport.fail_on = None
+    return d.output
+
+
+def test_plan_does_not_change_anything():
+    d = Deployment()
+    try:
+        output = plan(d)
+        assert 'Create spot m1.medium instance' in output
+        assert len(d.cloud.instances) == 0
+        assert d.transport.sent == []
+    finally:
+        d.cleanup()
+
+
+def test_plan_probes_nuxeo_installation():
+    d = Deployment()
+    try:
+        assert d.run() == 0
+        output = plan(d)
+        assert 'Reuse running instance' in output
+        assert 'Nuxeo already installed' in output
+        # The probe command is not mixed with the plan
+        assert 'test -x' not in output
+
+        assert 'Nuxeo not installed' in plan(d, probe_status=1 << 8)
+    finally:
+        d.cleanup()
+
+
+def test_plan_ssh_failure_is_not_a_missing_install():
+    d = Deployment()
+    try:
+        assert d.run() == 0
+        output = plan(d, probe_status=255 << 8)
+        assert 'could not check Nuxeo installation' in output
+        assert 'Nuxeo not installed' not in output
+    finally:
+        d.cleanup()
+
+
+def test_plan_skips_phases_completed_by_failed_run():
+    d = Deployment()
+    try:
+        d.fail('./node_agent.py')
+        output = plan(d)
+        assert output.count('Skip: ') == 3
+        assert 'Run node_agent.py' in output
+        assert 'Skip: Run node_agent.py' not in output
+    finally:
+        d.cleanup()
+
+
+def test_plan_cannot_be_combined_with_terminate():
+    d = Deployment()
+    try:
+        assert d.run() == 0
+        try:
+            d.run('--plan', '--terminate')
+        except SystemExit:
+            pass
+        else:
+            raise AssertionError('--plan --terminate should be rejected')
+        assert d.cloud.instances.popitem()[1].state == 'running'
+    finally:
+        d.cleanup()